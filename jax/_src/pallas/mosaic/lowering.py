@@ -74,6 +74,8 @@ class LoweringContext:
   grid_indices: Sequence[ir.Value] | None
   block_shapes: list[tuple[int | core.Mapped, ...]]
   name_stack: source_info_util.NameStack
+  # The number of devices the kernel will run on, if known.
+  num_devices: int | None = None
   replace = dataclasses.replace
 
 
@@ -143,18 +145,19 @@ def lower_jaxpr_to_module(
     grid_mapping: core.GridMapping,
     jaxpr: jax_core.Jaxpr,
     dimension_semantics: tuple[str | None, ...] | None,
+    num_devices: int | None = None,
 ) -> ir.Module:
   m = ir.Module.create()
   sym_tab = ir.SymbolTable(m.operation)
   if not grid_mapping.grid:
     # Trivial grid-map, we don't need to populate the transform functions.
     func_op = lower_jaxpr_to_func(ctx, jaxpr, grid_mapping=grid_mapping,
-                                  name="main")
+                                  name="main", num_devices=num_devices)
     m.body.append(func_op)
     sym_tab.insert(func_op)
     return m
   func_op = lower_jaxpr_to_func(ctx, jaxpr, grid_mapping=grid_mapping,
-                                name="main")
+                                name="main", num_devices=num_devices)
   m.body.append(func_op)
   sym_tab.insert(func_op)
   num_smem_inputs = grid_mapping.num_index_operands
@@ -255,6 +258,7 @@ def lower_jaxpr_to_func(
     *,
     grid_mapping: core.GridMapping | None,
     name: str,
+    num_devices: int | None = None,
 ) -> func.FuncOp:
   memory_spaces = [None if bm is None else bm.memory_space
                    for bm in grid_mapping.block_mappings]
@@ -304,12 +308,14 @@ def lower_jaxpr_to_func(
           tuple(grid_indices),
           block_shapes,
           source_info_util.NameStack(),
+          num_devices,
       )
       return jaxpr_subcomp(lowering_context, jaxpr, *args)
 
   else:
     lowering_context = LoweringContext(
-        ctx, None, None, block_shapes, source_info_util.NameStack()
+        ctx, None, None, block_shapes, source_info_util.NameStack(),
+        num_devices,
     )
     body_func = functools.partial(jaxpr_subcomp, lowering_context, jaxpr)
   body_func.__name__ = name
@@ -1429,22 +1435,33 @@ def _run_scoped_lowering_rule(ctx: LoweringRuleContext, *consts, jaxpr):
 lowering_rules[tpu_primitives.run_scoped_p] = _run_scoped_lowering_rule
 
 def _semaphore_signal_lowering_rule(ctx: LoweringRuleContext, semaphore,
-                                    value, *args, has_device_id: bool):
-  device_id = None
+                                    *args, inc: int | None, device_id=None):
   assert semaphore.type == ir.Type.parse("!tpu.semaphore")
-  if has_device_id:
-    (device_id,) = args
+  (value,) = args if inc is None else (ir_constant(inc),)
   return tpu.SemaphoreSignalOp(semaphore, value, device_id=device_id).results
 lowering_rules[tpu_primitives.semaphore_signal_p] = (
     _semaphore_signal_lowering_rule)
 
 
+def _remote_semaphore_signal_lowering_rule(ctx: LoweringRuleContext,
+                                           semaphore, device_id, *args,
+                                           inc: int | None):
+  return _semaphore_signal_lowering_rule(ctx, semaphore, *args, inc=inc,
+                                         device_id=device_id)
+lowering_rules[tpu_primitives.remote_semaphore_signal_p] = (
+    _remote_semaphore_signal_lowering_rule)
+
+
 def _semaphore_wait_lowering_rule(ctx: LoweringRuleContext, semaphore,
-                                  value):
+                                  *args, dec: int | None):
   sem_aval = ctx.avals_in[0]
   assert isinstance(sem_aval, tpu_core.AbstractSemaphore)
   assert sem_aval.sem_type is tpu_core.SemaphoreType.REGULAR
-  assert ctx.avals_in[1].dtype == jnp.dtype('int32')
+  if dec is None:
+    assert ctx.avals_in[1].dtype == jnp.dtype('int32')
+    (value,) = args
+  else:
+    value = ir_constant(dec)
   return tpu.SemaphoreWaitOp(semaphore, value).results
 lowering_rules[tpu_primitives.semaphore_wait_p] = _semaphore_wait_lowering_rule
 
@@ -1485,8 +1502,19 @@ def _dma_start_lowering_rule(ctx: LoweringRuleContext, *args, tree):
 lowering_rules[tpu_primitives.dma_start_p] = _dma_start_lowering_rule
 
 
+def _is_full_ref_indexer(indexer: NDIndexer) -> bool:
+  return all(
+      isinstance(i, primitives.Slice) and type(i.start) is int
+      and i.start == 0 and i.size == s
+      for i, s in zip(indexer.indices, indexer.shape)
+  )
+
+
 def _dma_wait_lowering_rule(ctx: LoweringRuleContext, *args, tree):
   sem, ref, idx = tree_util.tree_unflatten(tree, args)
+  if _is_full_ref_indexer(idx):
+    # Waiting on the whole Ref, no need to slice it first.
+    return tpu.WaitDMAOp(sem, ref).results
   starts, sizes = _indexer_to_start_size(idx)
   ref_ty = ir.MemRefType.get(
       tuple(sizes), mlir.dtype_to_ir_type(ctx.avals_in[1].dtype),
@@ -1496,5 +1524,8 @@ def _dma_wait_lowering_rule(ctx: LoweringRuleContext, *args, tree):
 lowering_rules[tpu_primitives.dma_wait_p] = _dma_wait_lowering_rule
 
 def _device_id_lowering_rule(ctx: LoweringRuleContext):
+  if ctx.lowering_context.num_devices == 1:
+    # There is only one device the kernel can be running on.
+    return ir_constant(0)
   return tpu.DeviceIdOp().result
 lowering_rules[tpu_primitives.device_id_p] = _device_id_lowering_rule
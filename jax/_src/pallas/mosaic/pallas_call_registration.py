@@ -23,12 +23,21 @@ from jax import core as jax_core
 from jax.experimental import mosaic
 from jax.experimental.mosaic.dialects import tpu
 from jax.interpreters import mlir
+from jax._src import sharding_impls
 from jax._src.lib.mlir import ir
 from jax._src.pallas import core
 from jax._src.pallas.mosaic import lowering
 from jax._src.pallas.pallas_call import pallas_call_p
 
 
+def _get_num_devices(axis_context) -> int | None:
+  if isinstance(axis_context, sharding_impls.ShardingContext):
+    return len(axis_context.device_assignment)
+  if isinstance(axis_context, sharding_impls.SPMDAxisContext):
+    return axis_context.mesh.size
+  return None
+
+
 def pallas_call_tpu_lowering_rule(
     ctx: mlir.LoweringRuleContext, *in_nodes,
     jaxpr: jax_core.Jaxpr,
@@ -65,7 +74,8 @@ def pallas_call_tpu_lowering_rule(
         "kernel_regeneration_metadata"
     )
     mosaic_module = lowering.lower_jaxpr_to_module(
-        mlir_ctx, grid_mapping, jaxpr, dimension_semantics=dimension_semantics)
+        mlir_ctx, grid_mapping, jaxpr, dimension_semantics=dimension_semantics,
+        num_devices=_get_num_devices(ctx.module_context.axis_context))
     if debug:
       print(mosaic_module)
   out_avals = [jax_core.ShapedArray(s.shape, s.dtype) for s in out_shapes]
@@ -15,8 +15,7 @@
 """Module for Pallas:TPU-specific JAX primitives and functions."""
 from __future__ import annotations
 
-import contextlib
-import dataclasses
+import functools
 from typing import Any, Callable
 
 import jax
@@ -31,10 +30,26 @@ from jax._src.interpreters import partial_eval as pe
 from jax._src.pallas import indexing
 from jax._src.pallas.mosaic import core as tpu_core
 import jax.numpy as jnp
+import numpy as np
 
 map, unsafe_map = util.safe_map, map
 zip, unsafe_zip = util.safe_zip, zip
 
+_INT32 = jnp.dtype("int32")
+
+
+def _as_int32(x: int | jax.Array) -> Any:
+  # Avoid going through `jnp.asarray` for the common cases of an int32 array
+  # (or tracer) and a Python int. Returns a `jax.Array` or an `np.int32`, both
+  # of which can be passed to `bind`.
+  if isinstance(x, jax.Array) and x.dtype == _INT32:
+    return x
+  if type(x) is int:
+    # A NumPy scalar rather than a cached `jnp.int32`, which would be staged
+    # out (and leak) if first built while tracing.
+    return np.int32(x)
+  return jnp.asarray(x, dtype=jnp.int32)
+
 repeat_p = jax_core.Primitive('repeat')
 
 def repeat(x, repeats, axis):
@@ -42,15 +57,23 @@ def repeat(x, repeats, axis):
 
 @repeat_p.def_abstract_eval
 def _repeat_abstract_eval(x, *, repeats, axis):
-  shape = list(x.shape)
-  shape[axis] *= repeats
+  axis = util.canonicalize_axis(axis, x.ndim)
+  shape = (*x.shape[:axis], x.shape[axis] * repeats, *x.shape[axis + 1:])
   return jax_core.ShapedArray(shape, x.dtype)
 
 
 def _repeat_lowering_rule(ctx: mlir.LoweringRuleContext, x, *, repeats, axis):
-  def _repeat(x):
-    return jnp.repeat(x, repeats, axis)
-  return mlir.lower_fun(_repeat, multiple_results=False)(ctx, x)
+  (x_aval,), (out_aval,) = ctx.avals_in, ctx.avals_out
+  axis = util.canonicalize_axis(axis, x_aval.ndim)
+  # Broadcast to a new minor axis right after `axis` and fold it into `axis`,
+  # so that each element along `axis` is repeated `repeats` times in a row.
+  shape = x_aval.shape
+  bcast_aval = x_aval.update(
+      shape=(*shape[:axis + 1], repeats, *shape[axis + 1:]))
+  bcast_dims = [i if i <= axis else i + 1 for i in range(len(shape))]
+  x = mlir.broadcast_in_dim(ctx, x, bcast_aval,
+                            broadcast_dimensions=bcast_dims)
+  return [mlir.reshape(ctx, x, out_aval)]
 mlir.register_lowering(repeat_p, _repeat_lowering_rule)
 
 trace_start_p = jax_core.Primitive('trace_start')
@@ -72,21 +95,47 @@ def _trace_stop_abstract_eval():
   return []
 
 
-@contextlib.contextmanager
-def trace(message: str, level: int = 10):
-  trace_start_p.bind(message=message, level=level)
-  yield
-  trace_stop_p.bind()
+class _Trace:
+  # A plain context manager avoids the generator machinery of
+  # `contextlib.contextmanager` on every enter/exit.
+  __slots__ = ["message", "level"]
+
+  def __init__(self, message: str, level: int):
+    self.message = message
+    self.level = level
+
+  def __enter__(self):
+    trace_start_p.bind(message=self.message, level=self.level)
+
+  def __exit__(self, *exc_info):
+    trace_stop_p.bind()
+
+
+def trace(message: str, level: int = 10) -> _Trace:
+  return _Trace(message, level)
 
 
 run_scoped_p = jax_core.Primitive('run_scoped')
 run_scoped_p.multiple_results = True
 
 
-def run_scoped(f: Callable[..., None], *types, **kw_types) -> None:
+def _flatten_scoped_types(types, kw_types):
   flat_types, in_tree = tree_util.tree_flatten((types, kw_types))
+  return in_tree, tuple(t.get_aval() for t in flat_types)
+
+
+@functools.lru_cache(maxsize=1024)
+def _flatten_scoped_types_cached(types, kw_types_items):
+  return _flatten_scoped_types(types, dict(kw_types_items))
+
+
+def run_scoped(f: Callable[..., None], *types, **kw_types) -> None:
+  try:
+    in_tree, avals = _flatten_scoped_types_cached(
+        types, tuple(kw_types.items()))
+  except TypeError:  # Some of the types (e.g. lists of types) aren't hashable.
+    in_tree, avals = _flatten_scoped_types(types, kw_types)
   flat_fun, _ = api_util.flatten_fun(lu.wrap_init(f), in_tree)
-  avals = map(lambda t: t.get_aval(), flat_types)
   jaxpr, _, consts = pe.trace_to_jaxpr_dynamic(flat_fun, avals)
   run_scoped_p.bind(*consts, jaxpr=jaxpr)
 
@@ -96,65 +145,96 @@ def _run_scoped_abstract_eval(*args, jaxpr):
   # jaxpr will have effects for its inputs (Refs that are allocated) and for
   # constvars (closed over Refs). The effects for the allocated Refs are local
   # to the jaxpr and shouldn't propagate out.
-  nonlocal_effects = {
+  num_consts = len(jaxpr.constvars)
+  nonlocal_effects = frozenset(
       eff for eff in jaxpr.effects
       if not (
           isinstance(eff, effects.JaxprInputEffect)
-          and eff.input_index >= len(jaxpr.constvars)
+          and eff.input_index >= num_consts
       )
-  }
+  )
   return [], nonlocal_effects
 
 
 semaphore_signal_p = jax_core.Primitive('semaphore_signal')
 semaphore_signal_p.multiple_results = True
 
+remote_semaphore_signal_p = jax_core.Primitive('remote_semaphore_signal')
+remote_semaphore_signal_p.multiple_results = True
+
+def _static_or_operand(
+    x: int | jax.Array,
+) -> tuple[list[Any], int | None]:
+  # Python ints are passed to the semaphore primitives as a static param
+  # rather than as an operand, so they don't need to be turned into arrays.
+  if type(x) is int:
+    return [], x
+  return [_as_int32(x)], None
+
 def semaphore_signal(sem, inc: int | jax.Array = 1,
                      *, device_id: int | jax.Array | None = None):
-  inc = jnp.asarray(inc, dtype=jnp.int32)
-  args = [sem, inc]
-  has_device_id = device_id is not None
-  if has_device_id:
-    args = [*args, device_id]
-  semaphore_signal_p.bind(*args, has_device_id=has_device_id)
-
-@semaphore_signal_p.def_abstract_eval
-def _semaphore_signal_abstract_eval(sem_aval: tpu_core.AbstractSemaphore, value,
-                                    *args, has_device_id: bool):
+  args, inc_param = _static_or_operand(inc)
+  if device_id is None:
+    semaphore_signal_p.bind(sem, *args, inc=inc_param)
+  else:
+    remote_semaphore_signal_p.bind(sem, _as_int32(device_id), *args,
+                                   inc=inc_param)
+
+def _check_semaphore_signal(sem_aval: tpu_core.AbstractSemaphore, args,
+                            inc: int | None):
   if not isinstance(sem_aval, tpu_core.AbstractSemaphore):
     raise ValueError(f"Cannot signal on a non-semaphore value: {sem_aval}")
   if sem_aval.sem_type is not tpu_core.SemaphoreType.REGULAR:
     raise ValueError("Must signal a REGULAR semaphore.")
-  if value.dtype != jnp.dtype("int32"):
-    raise ValueError("Must signal an int32 value.")
-  if has_device_id:
-    (device_id,) = args
-    if device_id.dtype != jnp.dtype("int32"):
-      raise ValueError("`device_id` must be an int32 value.")
+  if inc is None:
+    (value,) = args
+    if value.dtype != _INT32:
+      raise ValueError("Must signal an int32 value.")
+
+@semaphore_signal_p.def_abstract_eval
+def _semaphore_signal_abstract_eval(sem_aval: tpu_core.AbstractSemaphore,
+                                    *args, inc: int | None):
+  _check_semaphore_signal(sem_aval, args, inc)
+  return []
+
+@remote_semaphore_signal_p.def_abstract_eval
+def _remote_semaphore_signal_abstract_eval(
+    sem_aval: tpu_core.AbstractSemaphore, device_id, *args, inc: int | None):
+  _check_semaphore_signal(sem_aval, args, inc)
+  if device_id.dtype != _INT32:
+    raise ValueError("`device_id` must be an int32 value.")
   return []
 
 semaphore_wait_p = jax_core.Primitive('semaphore_wait')
 semaphore_wait_p.multiple_results = True
 
 def semaphore_wait(sem, dec: int | jax.Array = 1):
-  dec = jnp.asarray(dec, dtype=jnp.int32)
-  semaphore_wait_p.bind(sem, dec)
+  args, dec_param = _static_or_operand(dec)
+  semaphore_wait_p.bind(sem, *args, dec=dec_param)
 
 @semaphore_wait_p.def_abstract_eval
-def _semaphore_wait_abstract_eval(sem_aval: tpu_core.AbstractSemaphore, value):
+def _semaphore_wait_abstract_eval(sem_aval: tpu_core.AbstractSemaphore, *args,
+                                  dec: int | None):
   if not isinstance(sem_aval, tpu_core.AbstractSemaphore):
     raise ValueError(f"Cannot wait on a non-semaphore value: {sem_aval}")
   if sem_aval.sem_type is not tpu_core.SemaphoreType.REGULAR:
     raise ValueError("Must wait a REGULAR semaphore.")
-  if value.dtype != jnp.dtype("int32"):
-    raise ValueError("Must signal an int32 value.")
+  if dec is None:
+    (value,) = args
+    if value.dtype != _INT32:
+      raise ValueError("Must signal an int32 value.")
   return []
 
 
-@dataclasses.dataclass
 class DMAFuture:
-  flat_args: Any
-  tree: Any
+  __slots__ = ["flat_args", "tree"]
+
+  def __init__(self, flat_args: Any, tree: Any):
+    self.flat_args = flat_args
+    self.tree = tree
+
+  def __repr__(self) -> str:
+    return f"DMAFuture(flat_args={self.flat_args!r}, tree={self.tree!r})"
 
   def wait(self):
     dma_wait_p.bind(*self.flat_args, tree=self.tree)
@@ -167,32 +247,90 @@ def _dma_start_abstract_eval(*args, tree):
   del args, tree
   return []
 
+# The DMA primitives take flattened tuples of refs, indexers, semaphores and
+# device ids. Only the indexers have any structure of their own, so we build
+# the trees out of these and the indexer trees rather than flattening the whole
+# argument tuple on every call.
+_LEAF_TREE = tree_util.tree_structure(0)
+_NONE_TREE = tree_util.tree_structure(None)
+
+
+def _static_indices_key(indices) -> tuple[Any, ...] | None:
+  # Returns a hashable key for `indices` if they are all known statically and
+  # `None` otherwise.
+  key: list[Any] = []
+  for idx in indices:
+    if type(idx) is int:
+      key.append(idx)
+    elif isinstance(idx, slice):
+      if not all(i is None or type(i) is int
+                 for i in (idx.start, idx.stop, idx.step)):
+        return None
+      key.append((slice, idx.start, idx.stop, idx.step))
+    elif isinstance(idx, indexing.Slice):
+      if type(idx.start) is not int or type(idx.size) is not int:
+        return None
+      key.append((indexing.Slice, idx.start, idx.size))
+    else:
+      return None
+  return tuple(key)
+
+
+@functools.lru_cache(maxsize=1024)
+def _flatten_static_indexer(indices_key, shape):
+  indices = []
+  for idx in indices_key:
+    if type(idx) is int:
+      indices.append(idx)
+    elif idx[0] is slice:
+      indices.append(slice(*idx[1:]))
+    else:
+      indices.append(indexing.Slice(*idx[1:]))
+  indexer = indexing.NDIndexer.from_indices_shape(tuple(indices), shape)
+  flat_idx, idx_tree = tree_util.tree_flatten(indexer)
+  return tuple(flat_idx), idx_tree
+
+
+def _flatten_indexer(indices, shape):
+  # Indexers built only from static indices don't capture any tracers, so we
+  # can share them (and their flattened form) across calls instead of
+  # rebuilding them every time.
+  indices_key = _static_indices_key(indices)
+  if indices_key is None:
+    return tree_util.tree_flatten(
+        indexing.NDIndexer.from_indices_shape(indices, shape))
+  return _flatten_static_indexer(indices_key, tuple(shape))
+
+
 def dma_start(src_ref, src_indices, dst_ref, dst_indices, sem) -> DMAFuture:
-  src_indexer = indexing.NDIndexer.from_indices_shape(src_indices,
-                                                      src_ref.shape)
-  dst_indexer = indexing.NDIndexer.from_indices_shape(dst_indices,
-                                                      dst_ref.shape)
-  args = (src_ref, src_indexer, dst_ref, dst_indexer, sem, None, None)
-  flat_args, tree = tree_util.tree_flatten(args)
+  src_idx_args, src_idx_tree = _flatten_indexer(src_indices, src_ref.shape)
+  dst_idx_args, dst_idx_tree = _flatten_indexer(dst_indices, dst_ref.shape)
+  flat_args = [src_ref, *src_idx_args, dst_ref, *dst_idx_args, sem]
+  tree = tree_util.treedef_tuple(
+      (_LEAF_TREE, src_idx_tree, _LEAF_TREE, dst_idx_tree, _LEAF_TREE,
+       _NONE_TREE, _NONE_TREE))
   dma_start_p.bind(*flat_args, tree=tree)
-  wait_args, tree = tree_util.tree_flatten((sem, dst_ref, dst_indexer))
-  return DMAFuture(wait_args, tree)
+  wait_args = [sem, dst_ref, *dst_idx_args]
+  wait_tree = tree_util.treedef_tuple((_LEAF_TREE, _LEAF_TREE, dst_idx_tree))
+  return DMAFuture(wait_args, wait_tree)
 
 
 def remote_dma_start(src_ref, src_indices, dst_ref, dst_indices, src_sem,
                      dst_sem, device_id) -> tuple[DMAFuture, DMAFuture]:
-  src_indexer = indexing.NDIndexer.from_indices_shape(src_indices,
-                                                      src_ref.shape)
-  dst_indexer = indexing.NDIndexer.from_indices_shape(dst_indices,
-                                                      dst_ref.shape)
-  args = (src_ref, src_indexer, dst_ref, dst_indexer, dst_sem, src_sem,
-          device_id)
-  flat_args, tree = tree_util.tree_flatten(args)
+  # The send and recv waits reuse the indexers of the DMA itself, so flatten
+  # each indexer once and assemble all three trees from the pieces.
+  src_idx_args, src_idx_tree = _flatten_indexer(src_indices, src_ref.shape)
+  dst_idx_args, dst_idx_tree = _flatten_indexer(dst_indices, dst_ref.shape)
+  flat_args = [src_ref, *src_idx_args, dst_ref, *dst_idx_args, dst_sem,
+               src_sem, device_id]
+  tree = tree_util.treedef_tuple(
+      (_LEAF_TREE, src_idx_tree, _LEAF_TREE, dst_idx_tree, _LEAF_TREE,
+       _LEAF_TREE, _LEAF_TREE))
   dma_start_p.bind(*flat_args, tree=tree)
-  recv_wait_args = (dst_sem, dst_ref, dst_indexer)
-  recv_args, recv_tree = tree_util.tree_flatten(recv_wait_args)
-  send_wait_args = (src_sem, src_ref, src_indexer)
-  send_args, send_tree = tree_util.tree_flatten(send_wait_args)
+  recv_args = [dst_sem, dst_ref, *dst_idx_args]
+  recv_tree = tree_util.treedef_tuple((_LEAF_TREE, _LEAF_TREE, dst_idx_tree))
+  send_args = [src_sem, src_ref, *src_idx_args]
+  send_tree = tree_util.treedef_tuple((_LEAF_TREE, _LEAF_TREE, src_idx_tree))
   return DMAFuture(send_args, send_tree), DMAFuture(recv_args, recv_tree)
 
 
@@ -208,6 +346,6 @@ device_id_p = jax_core.Primitive('device_id')
 
 @device_id_p.def_abstract_eval
 def _device_id_abstract_eval():
-  return jax_core.ShapedArray((), jnp.dtype("int32"))
+  return jax_core.ShapedArray((), _INT32)
 
 device_id = device_id_p.bind
@@ -0,0 +1,315 @@
+# Copyright 2023 The JAX Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for Pallas TPU primitives and their lowering helpers."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+import jax
+from jax import tree_util
+from jax._src import core as jax_core
+from jax._src import sharding_impls
+from jax._src import source_info_util
+from jax._src.lib.mlir import ir
+from jax._src.pallas import indexing
+from jax._src.pallas.mosaic import core as tpu_core
+from jax._src.pallas.mosaic import lowering as tpu_lowering
+from jax._src.pallas.mosaic import pallas_call_registration
+from jax._src.pallas.mosaic import primitives as tpu_primitives
+from jax.experimental import enable_x64
+from jax.experimental.mosaic.dialects import tpu
+import jax.numpy as jnp
+import numpy as np
+
+
+class DMAIndexerTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    tpu_primitives._flatten_static_indexer.cache_clear()
+
+  def test_static_indices_are_cached(self):
+    indices = (0, slice(None), indexing.ds(2, 4))
+    shape = (4, 8, 8)
+    flat_idx, idx_tree = tpu_primitives._flatten_indexer(indices, shape)
+    flat_idx2, idx_tree2 = tpu_primitives._flatten_indexer(indices, shape)
+    cache_info = tpu_primitives._flatten_static_indexer.cache_info()
+    self.assertEqual(cache_info.misses, 1)
+    self.assertEqual(cache_info.hits, 1)
+    self.assertIs(flat_idx, flat_idx2)
+    self.assertEqual(idx_tree, idx_tree2)
+
+    expected_flat_idx, expected_idx_tree = tree_util.tree_flatten(
+        indexing.NDIndexer.from_indices_shape(indices, shape))
+    self.assertEqual(idx_tree, expected_idx_tree)
+    self.assertLen(flat_idx, len(expected_flat_idx))
+    for x, y in zip(flat_idx, expected_flat_idx):
+      np.testing.assert_array_equal(x, y)
+
+  def test_array_indices_are_not_cached(self):
+    idx = np.array(1, np.int32)
+    flat_idx, _ = tpu_primitives._flatten_indexer((idx, slice(None)), (4, 8))
+    self.assertLen(flat_idx, 1)
+    self.assertIs(flat_idx[0], idx)
+    self.assertEqual(
+        tpu_primitives._flatten_static_indexer.cache_info().currsize, 0)
+
+  def test_traced_indices_are_not_cached(self):
+    def f(i):
+      flat_idx, _ = tpu_primitives._flatten_indexer(
+          (i, indexing.ds(i, 2)), (4, 8))
+      self.assertLen(flat_idx, 2)
+      self.assertIs(flat_idx[0], i)
+      return i
+
+    jax.make_jaxpr(f)(1)
+    self.assertEqual(
+        tpu_primitives._flatten_static_indexer.cache_info().currsize, 0)
+
+
+class FullRefIndexerTest(parameterized.TestCase):
+
+  @parameterized.named_parameters(
+      ("empty", (), True),
+      ("full_slice", (slice(None),), True),
+      ("full_ds", (indexing.ds(0, 4), slice(None)), True),
+      ("short_ds", (indexing.ds(0, 2),), False),
+      ("nonzero_start", (indexing.Slice(1, 4),), False),
+      ("int_index", (0,), False),
+  )
+  def test_static_indices(self, indices, expected):
+    indexer = indexing.NDIndexer.from_indices_shape(indices, (4, 8))
+    self.assertEqual(tpu_lowering._is_full_ref_indexer(indexer), expected)
+
+  def test_traced_start_is_not_full(self):
+    def f(i):
+      indexer = indexing.NDIndexer.from_indices_shape(
+          (indexing.ds(i, 4),), (4, 8))
+      self.assertFalse(tpu_lowering._is_full_ref_indexer(indexer))
+      return i
+
+    jax.make_jaxpr(f)(0)
+
+
+class RepeatTest(parameterized.TestCase):
+
+  @parameterized.parameters(
+      (0, (4, 3)), (1, (2, 6)), (-1, (2, 6)), (-2, (4, 3)))
+  def test_repeat_shape(self, axis, expected_shape):
+    x = jax.ShapeDtypeStruct((2, 3), jnp.float32)
+    out = jax.eval_shape(lambda x: tpu_primitives.repeat(x, 2, axis), x)
+    self.assertEqual(out.shape, expected_shape)
+
+  @parameterized.parameters(0, 1, 2, -1, -2, -3)
+  def test_repeat_matches_jnp_repeat(self, axis):
+    x = jnp.arange(24).reshape(2, 3, 4)
+    out = jax.jit(lambda x: tpu_primitives.repeat(x, 2, axis))(x)
+    np.testing.assert_array_equal(out, jnp.repeat(x, 2, axis))
+
+
+class RunScopedTest(parameterized.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    tpu_primitives._flatten_scoped_types_cached.cache_clear()
+
+  def test_hashable_types_are_cached(self):
+    def f():
+      tpu_primitives.run_scoped(lambda sem: None,
+                                tpu_core.SemaphoreType.REGULAR)
+      tpu_primitives.run_scoped(lambda sem: None,
+                                tpu_core.SemaphoreType.REGULAR)
+      return []
+
+    jax.make_jaxpr(f)()
+    cache_info = tpu_primitives._flatten_scoped_types_cached.cache_info()
+    self.assertEqual(cache_info.misses, 1)
+    self.assertEqual(cache_info.hits, 1)
+
+  def test_unhashable_types_are_not_cached(self):
+    types = ([tpu_core.SemaphoreType.DMA] * 2,)
+    kw_types = dict(
+        scratch={"a": tpu_core.TPUMemorySpace.VMEM((8, 128), jnp.float32)})
+    num_sems = 0
+
+    def body(sems, scratch):
+      nonlocal num_sems
+      num_sems = len(sems)
+      self.assertEqual(set(scratch), {"a"})
+
+    def f():
+      tpu_primitives.run_scoped(body, *types, **kw_types)
+      return []
+
+    jax.make_jaxpr(f)()
+    self.assertEqual(num_sems, 2)
+    self.assertEqual(
+        tpu_primitives._flatten_scoped_types_cached.cache_info().currsize, 0)
+
+    in_tree, avals = tpu_primitives._flatten_scoped_types(types, kw_types)
+    flat_types, expected_in_tree = tree_util.tree_flatten((types, kw_types))
+    self.assertEqual(in_tree, expected_in_tree)
+    self.assertEqual(avals, tuple(t.get_aval() for t in flat_types))
+
+  def test_memory_spaces_are_not_conflated(self):
+    vmem_ref = tpu_core.TPUMemorySpace.VMEM((8, 128), jnp.float32)
+    smem_ref = tpu_core.TPUMemorySpace.SMEM((8, 128), jnp.float32)
+    (vmem_aval,) = tpu_primitives._flatten_scoped_types_cached(
+        (vmem_ref,), ())[1]
+    (smem_aval,) = tpu_primitives._flatten_scoped_types_cached(
+        (smem_ref,), ())[1]
+    self.assertEqual(
+        tpu_primitives._flatten_scoped_types_cached.cache_info().currsize, 2)
+    self.assertEqual(vmem_aval.memory_space, tpu_core.TPUMemorySpace.VMEM)
+    self.assertEqual(smem_aval.memory_space, tpu_core.TPUMemorySpace.SMEM)
+
+  def test_body_is_traced_every_time(self):
+    num_traces = 0
+
+    def body(sem):
+      del sem
+      nonlocal num_traces
+      num_traces += 1
+
+    def f():
+      tpu_primitives.run_scoped(body, tpu_core.SemaphoreType.REGULAR)
+      tpu_primitives.run_scoped(body, tpu_core.SemaphoreType.REGULAR)
+      return []
+
+    jax.make_jaxpr(f)()
+    self.assertEqual(num_traces, 2)
+    jax.make_jaxpr(f)()
+    self.assertEqual(num_traces, 4)
+
+  def test_body_is_retraced_under_new_config(self):
+    def body(sem):
+      del sem
+      jnp.arange(4)
+
+    def f():
+      tpu_primitives.run_scoped(body, tpu_core.SemaphoreType.REGULAR)
+      return []
+
+    def inner_dtype():
+      (eqn,) = jax.make_jaxpr(f)().eqns
+      (iota_eqn,) = eqn.params["jaxpr"].eqns
+      return iota_eqn.outvars[0].aval.dtype
+
+    with enable_x64(False):
+      self.assertEqual(inner_dtype(), np.dtype("int32"))
+    with enable_x64(True):
+      self.assertEqual(inner_dtype(), np.dtype("int64"))
+
+
+class SemaphoreTest(parameterized.TestCase):
+
+  def _scoped_eqns(self, body):
+    def f():
+      tpu_primitives.run_scoped(body, tpu_core.SemaphoreType.REGULAR)
+      return []
+
+    (eqn,) = jax.make_jaxpr(f)().eqns
+    return eqn.params["jaxpr"].eqns
+
+  def test_python_int_is_passed_as_param(self):
+    def body(sem):
+      tpu_primitives.semaphore_signal(sem, 2)
+      tpu_primitives.semaphore_signal(sem, device_id=3)
+      tpu_primitives.semaphore_wait(sem)
+
+    signal, remote_signal, wait = self._scoped_eqns(body)
+    self.assertIs(signal.primitive, tpu_primitives.semaphore_signal_p)
+    self.assertLen(signal.invars, 1)
+    self.assertEqual(signal.params["inc"], 2)
+    self.assertIs(remote_signal.primitive,
+                  tpu_primitives.remote_semaphore_signal_p)
+    self.assertLen(remote_signal.invars, 2)
+    self.assertEqual(remote_signal.params["inc"], 1)
+    self.assertIs(wait.primitive, tpu_primitives.semaphore_wait_p)
+    self.assertLen(wait.invars, 1)
+    self.assertEqual(wait.params["dec"], 1)
+
+  def test_array_is_passed_as_operand(self):
+    def body(sem):
+      tpu_primitives.semaphore_signal(sem, jnp.int32(2))
+      tpu_primitives.semaphore_wait(sem, jnp.int32(2))
+
+    eqns = [eqn for eqn in self._scoped_eqns(body)
+            if eqn.primitive in (tpu_primitives.semaphore_signal_p,
+                                 tpu_primitives.semaphore_wait_p)]
+    signal, wait = eqns
+    self.assertLen(signal.invars, 2)
+    self.assertIsNone(signal.params["inc"])
+    self.assertLen(wait.invars, 2)
+    self.assertIsNone(wait.params["dec"])
+
+  def test_non_int32_operand_is_rejected(self):
+    def body(sem):
+      semaphore_signal_p = tpu_primitives.semaphore_signal_p
+      semaphore_signal_p.bind(sem, jnp.float32(1.), inc=None)
+
+    with self.assertRaisesRegex(ValueError, "Must signal an int32 value"):
+      self._scoped_eqns(body)
+
+
+class DeviceIdTest(parameterized.TestCase):
+
+  def test_num_devices_sharding_context(self):
+    devices = tuple(jax.devices()[:1])
+    self.assertEqual(
+        pallas_call_registration._get_num_devices(
+            sharding_impls.ShardingContext(devices)), 1)
+    self.assertEqual(
+        pallas_call_registration._get_num_devices(
+            sharding_impls.ShardingContext(devices * 4)), 4)
+
+  def test_num_devices_spmd_axis_context(self):
+    devices = np.array(jax.devices())
+    mesh = jax.sharding.Mesh(devices, ("x",))
+    self.assertEqual(
+        pallas_call_registration._get_num_devices(
+            sharding_impls.SPMDAxisContext(mesh)), len(devices))
+
+  def test_num_devices_replica_axis_context(self):
+    axis_env = sharding_impls.AxisEnv(nreps=2, names=("i",), sizes=(2,))
+    self.assertIsNone(
+        pallas_call_registration._get_num_devices(
+            sharding_impls.ReplicaAxisContext(axis_env)))
+
+  def _lower_device_id(self, num_devices):
+    with ir.Context() as mlir_ctx, ir.Location.unknown(mlir_ctx):
+      tpu.register_dialect(mlir_ctx)
+      module = ir.Module.create()
+      with ir.InsertionPoint(module.body):
+        lowering_ctx = tpu_lowering.LoweringContext(
+            mlir_ctx, None, None, [], source_info_util.NameStack(),
+            num_devices)
+        rule_ctx = tpu_lowering.LoweringRuleContext(
+            lowering_ctx, [], [jax_core.ShapedArray((), jnp.int32)], None)
+        tpu_lowering._device_id_lowering_rule(rule_ctx)
+      return str(module)
+
+  def test_device_id_is_folded_for_single_device(self):
+    module = self._lower_device_id(1)
+    self.assertIn("arith.constant 0 : i32", module)
+    self.assertNotIn("tpu.device_id", module)
+
+  @parameterized.parameters(None, 2)
+  def test_device_id_is_kept_for_multiple_devices(self, num_devices):
+    module = self._lower_device_id(num_devices)
+    self.assertIn("tpu.device_id", module)
+
+
+if __name__ == "__main__":
+  absltest.main()